@@ -17,19 +17,23 @@ class QNetwork:
     Contains a TensorFlow graph which is suitable for learning the Tic Tac Toe Q function
     """
 
-    def __init__(self, name: str, learning_rate: float):
+    def __init__(self, name: str, learning_rate: float, hidden_size: int = BOARD_SIZE * 3 * 9):
         """
         Constructor for QNetwork. Takes a name and a learning rate for the GradientDescentOptimizer
         :param name: Name of the network
         :param learning_rate: Learning rate for the GradientDescentOptimizer
+        :param hidden_size: Number of units in the hidden layer
         """
         self.learningRate = learning_rate
+        self.hidden_size = hidden_size
         self.name = name
         self.input_positions = None
         self.target_input = None
         self.q_values = None
-        self.probabilities = None
         self.train_step = None
+        self.session = None
+        self.predict_fn = None
+        self.train_fn = None
         self.build_graph(name)
 
     def add_dense_layer(self, input_tensor: tf.Tensor, output_size: int, activation_fn=None,
@@ -53,43 +57,89 @@ class QNetwork:
         :param name: The scope for the graph. Needs to be unique for the session.
         """
         with tf.variable_scope(name):
-            self.input_positions = tf.placeholder(tf.float32, shape=(None, BOARD_SIZE * 3), name='inputs')
+            self.input_positions = tf.placeholder(tf.uint8, shape=(None, BOARD_SIZE * 3), name='inputs')
 
             self.target_input = tf.placeholder(tf.float32, shape=(None, BOARD_SIZE), name='targets')
 
-            net = self.input_positions
+            # The feature vectors are bit arrays and are fed as bytes. We cast them to float in the graph.
+            net = tf.cast(self.input_positions, tf.float32)
 
-            net = self.add_dense_layer(net, BOARD_SIZE * 3 * 9, tf.nn.relu)
+            net = self.add_dense_layer(net, self.hidden_size, tf.nn.relu)
 
             self.q_values = self.add_dense_layer(net, BOARD_SIZE, name='q_values')
 
-            self.probabilities = tf.nn.softmax(self.q_values, name='probabilities')
-            mse = tf.losses.mean_squared_error(predictions=self.q_values, labels=self.target_input)
+            mse = tf.losses.mean_squared_error(predictions=self.q_values, labels=self.target_input,
+                                               loss_collection=None)
             self.train_step = tf.train.GradientDescentOptimizer(learning_rate=self.learningRate).minimize(mse,
                                                                                                           name='train')
 
+    def bind_session(self):
+        """
+        Creates the session callables for inference and training, unless they already exist for the current shared
+        session. The callables are created once and reused, so we don't pay for `Session.run` re-processing its
+        fetch and feed arguments on every single move or training step.
+        """
+        session = TFSN.get_session()
+        if self.session is not session:
+            self.predict_fn = session.make_callable(self.q_values, [self.input_positions])
+            self.train_fn = session.make_callable(self.train_step, [self.input_positions, self.target_input])
+            self.session = session
+
+    def predict(self, input_pos: np.ndarray) -> np.ndarray:
+        """
+        Feeds a batch of feature vectors into the Neural Network and returns the corresponding Q values.
+        :param input_pos: The batch of feature vectors to be fed into the Neural Network.
+        :return: The q values for each feature vector in the batch.
+        """
+        self.bind_session()
+        return self.predict_fn(np.asarray(input_pos, dtype=np.uint8))
+
+    def fit(self, input_pos: np.ndarray, targets: np.ndarray):
+        """
+        Runs a single training step of the Neural Network on a batch of feature vectors and their target Q values.
+        :param input_pos: The batch of feature vectors to train on.
+        :param targets: The target Q values for each feature vector in the batch.
+        """
+        self.bind_session()
+        self.train_fn(np.asarray(input_pos, dtype=np.uint8), np.asarray(targets, dtype=np.float32))
+
 
 class NNQPlayer(Player):
     """
     Implements a Tic Tac Toe player based on a Reinforcement Neural Network learning the Tic Tac Toe Q function
     """
 
-    def board_state_to_nn_input(self, state: np.ndarray) -> np.ndarray:
+    #
+    # Lookup table from our side and the content of a board position to the 3 feature vector bits for that position
+    # (our piece, opponent's piece, empty). Indexed as FEATURE_LUT[side, bit, content].
+    #
+    FEATURE_LUT = np.zeros((3, 3, 3), dtype=np.uint8)
+    FEATURE_LUT[NAUGHT, 0, NAUGHT] = FEATURE_LUT[NAUGHT, 1, CROSS] = FEATURE_LUT[NAUGHT, 2, EMPTY] = 1
+    FEATURE_LUT[CROSS, 0, CROSS] = FEATURE_LUT[CROSS, 1, NAUGHT] = FEATURE_LUT[CROSS, 2, EMPTY] = 1
+
+    def board_state_to_nn_input(self, state: np.ndarray, out: np.ndarray = None) -> np.ndarray:
         """
         Converts a Tic Tac Tow board state to an input feature vector for the Neural Network. The input feature vector
         is a bit array of size 27. The first 9 bits are set to 1 on positions containing the player's pieces, the second
         9 bits are set to 1 on positions with our opponents pieces, and the final 9 bits are set on empty positions on
         the board.
         :param state: The board state that is to be converted to a feature vector.
+        :param out: Optional uint8 array of size 27 to write the feature vector into. It must be possible to view it
+        as a 3x9 array without copying, e.g. a row of the position log.
         :return: The feature vector representing the input Tic Tac Toe board state.
         """
-        res = np.array([(state == self.side).astype(int),
-                        (state == Board.other_side(self.side)).astype(int),
-                        (state == EMPTY).astype(int)])
-        return res.reshape(-1)
+        if out is None:
+            out = np.empty(BOARD_SIZE * 3, dtype=np.uint8)
+        # We write the 3 bit planes through a 3x9 view of `out`. Setting the shape of a view, unlike `reshape`,
+        # raises instead of silently making a copy if `out` can't be viewed that way.
+        planes = out.view()
+        planes.shape = (3, BOARD_SIZE)
+        np.take(self.FEATURE_LUT[self.side], state, axis=1, out=planes)
+        return out
 
     def __init__(self, name: str, reward_discount: float = 0.95, win_value: float = 1.0, draw_value: float = 0.0,
-                 loss_value: float = -1.0, learning_rate: float = 0.01, training: bool = True):
+                 loss_value: float = -1.0, learning_rate: float = 0.01, training: bool = True,
+                 hidden_size: int = BOARD_SIZE * 3 * 9):
         """
         Constructor for the Neural Network player.
         :param name: The name of the player. Also the name of its TensorFlow scope. Needs to be unique
@@ -100,18 +150,23 @@ class NNQPlayer(Player):
         :param learning_rate: The learning rate of the Neural Network
         :param training: Flag indicating if the Neural Network should adjust its weights based on the game outcome
         (True), or just play the game without further adjusting its weights (False).
+        :param hidden_size: Number of units in the hidden layer of the Neural Network. The cost of evaluating and
+        training the network grows linearly with it.
         """
         self.reward_discount = reward_discount
         self.win_value = win_value
         self.draw_value = draw_value
         self.loss_value = loss_value
         self.side = None
-        self.board_position_log = []
-        self.action_log = []
-        self.next_max_log = []
-        self.values_log = []
+        # A player makes at most BOARD_SIZE moves per game, so we keep the game logs in fixed size arrays that are
+        # allocated once and reused for every game. `move_count` is the number of moves recorded so far.
+        self.board_position_log = np.zeros((BOARD_SIZE, BOARD_SIZE * 3), dtype=np.uint8)
+        self.action_log = np.zeros(BOARD_SIZE, dtype=np.intp)
+        self.next_max_log = np.zeros(BOARD_SIZE, dtype=np.float32)
+        self.values_log = np.zeros((BOARD_SIZE, BOARD_SIZE), dtype=np.float32)
+        self.move_count = 0
         self.name = name
-        self.nn = QNetwork(name, learning_rate)
+        self.nn = QNetwork(name, learning_rate, hidden_size)
         self.training = training
         super().__init__()
 
@@ -121,36 +176,30 @@ class NNQPlayer(Player):
         :param side: The side it will play in the new game.
         """
         self.side = side
-        self.board_position_log = []
-        self.action_log = []
-        self.next_max_log = []
-        self.values_log = []
+        self.move_count = 0
 
-    def calculate_targets(self) -> [np.ndarray]:
+    def calculate_targets(self) -> np.ndarray:
         """
-        Based on the recorded moves, compute updated estimates of the Q values for the network to learn
+        Based on the recorded moves, compute updated estimates of the Q values for the network to learn.
+        The targets are written in place over the recorded Q values, which are not needed once the game is over.
+        :return: A view of `values_log` holding the target Q values of the recorded moves.
         """
-        game_length = len(self.action_log)
-        targets = []
-
-        for i in range(game_length):
-            target = np.copy(self.values_log[i])
+        game_length = self.move_count
+        targets = self.values_log[:game_length]
 
-            target[self.action_log[i]] = self.reward_discount * self.next_max_log[i]
-            targets.append(target)
+        targets[np.arange(game_length), self.action_log[:game_length]] = \
+            self.reward_discount * self.next_max_log[:game_length]
 
         return targets
 
-    def get_probs(self, input_pos: np.ndarray) -> ([float], [float]):
+    def get_qvalues(self, input_pos: np.ndarray) -> [float]:
         """
         Feeds the feature vector `input_pos` which encodes a board state into the Neural Network and computes the
-        Q values and corresponding probabilities for all moves (including illegal ones).
+        Q values for all moves (including illegal ones).
         :param input_pos: The feature vector to be fed into the Neural Network.
-        :return: A tuple of probabilities and q values of all actions (including illegal ones).
+        :return: The q values of all actions (including illegal ones).
         """
-        probs, qvalues = TFSN.get_session().run([self.nn.probabilities, self.nn.q_values],
-                                                feed_dict={self.nn.input_positions: [input_pos]})
-        return probs[0], qvalues[0]
+        return self.nn.predict([input_pos])[0]
 
     def move(self, board: Board) -> (GameResult, bool):
         """
@@ -159,33 +208,34 @@ class NNQPlayer(Player):
         :return: A tuple of the GameResult and a flag indicating if the game is over after this move.
         """
 
-        # We record all game positions to feed them into the NN for training with the corresponding updated Q
-        # values.
-        self.board_position_log.append(board.state.copy())
+        # In training mode we record all game positions as feature vectors to feed them into the NN for training
+        # with the corresponding updated Q values. Otherwise there is no need to keep them.
+        if self.training:
+            nn_input = self.board_state_to_nn_input(board.state, self.board_position_log[self.move_count])
+        else:
+            nn_input = self.board_state_to_nn_input(board.state)
 
-        nn_input = self.board_state_to_nn_input(board.state)
-        probs, qvalues = self.get_probs(nn_input)
-        qvalues = np.copy(qvalues)
+        qvalues = self.get_qvalues(nn_input)
 
-        # We filter out all illegal moves by setting the probability to -1. We don't change the q values
-        # as we don't want the NN to waste any effort of learning different Q values for moves that are illegal
-        # anyway.
-        for index, p in enumerate(qvalues):
-            if not board.is_legal(index):
-                probs[index] = -1
+        # We filter out all illegal moves by setting their Q value to -inf in a masked copy. We don't change the
+        # recorded q values as we don't want the NN to waste any effort of learning different Q values for moves
+        # that are illegal anyway.
+        legal_qvalues = np.where(board.state == EMPTY, qvalues, -np.inf)
 
-        # Our next move is the one with the highest probability after removing all illegal ones.
-        move = np.argmax(probs)  # int
+        # Our next move is the one with the highest Q value after removing all illegal ones.
+        move = int(np.argmax(legal_qvalues))
 
-        # Unless this is the very first move, the Q values of the selected move is also the max Q value of
-        # the move that got the game from the previous state to this one.
-        if len(self.action_log) > 0:
-            self.next_max_log.append(qvalues[move])
+        if self.training:
+            # Unless this is the very first move, the Q values of the selected move is also the max Q value of
+            # the move that got the game from the previous state to this one.
+            if self.move_count > 0:
+                self.next_max_log[self.move_count - 1] = qvalues[move]
 
-        # We record the action we selected as well as the Q values of the current state for later use when
-        # adjusting NN weights.
-        self.action_log.append(move)
-        self.values_log.append(qvalues)
+            # We record the action we selected as well as the Q values of the current state for later use when
+            # adjusting NN weights.
+            self.action_log[self.move_count] = move
+            self.values_log[self.move_count] = qvalues
+            self.move_count += 1
 
         # We execute the move and return the result
         _, res, finished = board.move(move, self.side)
@@ -210,18 +260,14 @@ class NNQPlayer(Player):
         else:
             raise ValueError("Unexpected game result {}".format(result))
 
-        # The final reward is also the Q value we want to learn for the action that led to it.
-        self.next_max_log.append(reward)
-
-        # If we are in training mode we run the optimizer.
+        # If we are in training mode we run the optimizer. Otherwise nothing was recorded during the game.
         if self.training:
+            # The final reward is also the Q value we want to learn for the action that led to it.
+            self.next_max_log[self.move_count - 1] = reward
+
             # We calculate our new estimate of what the true Q values are and feed that into the network as
             # learning target
             targets = self.calculate_targets()
 
-            # We convert the input states we have recorded to feature vectors to feed into the training.
-            nn_input = [self.board_state_to_nn_input(x) for x in self.board_position_log]
-
             # We run the training step with the recorded inputs and new Q value targets.
-            TFSN.get_session().run([self.nn.train_step],
-                                   feed_dict={self.nn.input_positions: nn_input, self.nn.target_input: targets})
+            self.nn.fit(self.board_position_log[:self.move_count], targets)